@@ -7,6 +7,7 @@ import pandas as pd
 import torch
 from torch import nn, optim
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 from torch import Tensor
 from torchvision.models.resnet import resnet50, resnet18, resnet34, resnet101
 from tqdm import tqdm
@@ -34,9 +35,11 @@ import warnings
 
 
 warnings.filterwarnings("ignore")
-for dirname, _, filenames in os.walk('/kaggle/input'):
-    for filename in filenames:
-        print(os.path.join(dirname, filename))
+# walking the whole input tree is slow on a cold cache, set DEBUG_LIST_INPUT=1 to list it
+if os.environ.get("DEBUG_LIST_INPUT"):
+    for dirname, _, filenames in os.walk('/kaggle/input'):
+        for filename in filenames:
+            print(os.path.join(dirname, filename))
 
 
 # test validness for the online environment
@@ -51,7 +54,22 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     
-set_seed(42)
+SEED = 42
+set_seed(SEED)
+
+
+# DataLoader workers are separate processes, seed each of them deterministically as well
+def seed_worker(worker_id):
+    worker_seed = SEED + worker_id
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+
+
+# shapes are fixed, so let cuDNN autotune the conv algorithms once; allow TF32 on Ampere
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 
 # --- Lyft configs ---
@@ -88,14 +106,16 @@ cfg = {
         'key': 'scenes/train.zarr',
         'batch_size': 16,
         'shuffle': True,
-        'num_workers': 4
+        'num_workers': min(os.cpu_count() or 1, 8),
+        'prefetch_factor': 4
     },
     
     'test_data_loader': {
         'key': 'scenes/test.zarr',
         'batch_size': 32,
         'shuffle': False,
-        'num_workers': 4
+        'num_workers': min(os.cpu_count() or 1, 8),
+        'prefetch_factor': 4
     },
 
     'train_params': {
@@ -111,25 +131,52 @@ os.environ["L5KIT_DATA_FOLDER"] = DIR_INPUT
 dm = LocalDataManager(None)
 
 
+# the rasterizers produce multiples of 1/255, so ship the image to the GPU as uint8 (4x less to copy)
+# and scale it back to [0, 1] there, see forward()
+class UInt8ImageAgentDataset(AgentDataset):
+
+    def __getitem__(self, index):
+        data = super().__getitem__(index)
+        data["image"] = np.round(data["image"] * 255).astype(np.uint8)
+        return data
+
+
 # ===== INIT TRAIN DATASET============================================================
-train_cfg = cfg["train_data_loader"]
-rasterizer = build_rasterizer(cfg, dm)
-train_zarr = ChunkedDataset(dm.require(train_cfg["key"])).open()
-train_dataset = AgentDataset(cfg, train_zarr, rasterizer)
-train_dataloader = DataLoader(train_dataset, shuffle=train_cfg["shuffle"], batch_size=train_cfg["batch_size"], 
-                             num_workers=train_cfg["num_workers"])
-print("==================================TRAIN DATA==================================")
-print(train_dataset)
+# only opened when training, the predict path needs just the test set
+if cfg["model_params"]["train"]:
+    train_cfg = cfg["train_data_loader"]
+    rasterizer = build_rasterizer(cfg, dm)
+    train_zarr = ChunkedDataset(dm.require(train_cfg["key"])).open()
+    train_dataset = UInt8ImageAgentDataset(cfg, train_zarr, rasterizer)
+    train_dataloader = DataLoader(train_dataset, shuffle=train_cfg["shuffle"], batch_size=train_cfg["batch_size"], 
+                                 num_workers=train_cfg["num_workers"], pin_memory=True,
+                                 persistent_workers=True, prefetch_factor=train_cfg["prefetch_factor"],
+                                 worker_init_fn=seed_worker, generator=torch.Generator().manual_seed(SEED))
+    print("==================================TRAIN DATA==================================")
+    print(train_dataset)
 
 
 #====== INIT TEST DATASET=============================================================
+# collate test batches in the workers and keep only what the post-processing needs of world_from_agent:
+# offset_from_agent (batch_size)x2x3 maps agent coordinates to offsets from the agent centroid
+def collate_test_batch(batch):
+    data = default_collate(batch)
+    offset_from_agent = data.pop("world_from_agent")[:, :2]  # the bottom row is always [0, 0, 1]
+    # subtract the centroid in float64 first, world coordinates are large
+    offset_from_agent[:, :, 2] -= data["centroid"][:, :2]
+    data["offset_from_agent"] = offset_from_agent.float()
+    return data
+
+
 test_cfg = cfg["test_data_loader"]
 rasterizer = build_rasterizer(cfg, dm)
 test_zarr = ChunkedDataset(dm.require(test_cfg["key"])).open()
 test_mask = np.load(f"{DIR_INPUT}/scenes/mask.npz")["arr_0"]
-test_dataset = AgentDataset(cfg, test_zarr, rasterizer, agents_mask=test_mask)
+test_dataset = UInt8ImageAgentDataset(cfg, test_zarr, rasterizer, agents_mask=test_mask)
 test_dataloader = DataLoader(test_dataset,shuffle=test_cfg["shuffle"],batch_size=test_cfg["batch_size"],
-                             num_workers=test_cfg["num_workers"])
+                             num_workers=test_cfg["num_workers"], pin_memory=True, collate_fn=collate_test_batch,
+                             persistent_workers=True, prefetch_factor=test_cfg["prefetch_factor"],
+                             worker_init_fn=seed_worker, generator=torch.Generator().manual_seed(SEED))
 print("==================================TEST DATA==================================")
 print(test_dataset)
 
@@ -137,7 +184,7 @@ print(test_dataset)
 # visualize how an input to the model looks like.
 def visualize_trajectory(dataset, index, title="target_positions movement with draw_trajectory"):
     data = dataset[index]
-    im = data["image"].transpose(1, 2, 0)
+    im = data["image"].transpose(1, 2, 0).astype(np.float32) / 255
     im = dataset.rasterizer.to_rgb(im)
     target_positions_pixels = transform_points(data["target_positions"] + data["centroid"][:2], data["world_to_image"])
     draw_trajectory(im, target_positions_pixels, TARGET_POINTS_COLOR, radius=1, yaws=data["target_yaws"])
@@ -146,18 +193,23 @@ def visualize_trajectory(dataset, index, title="target_positions movement with d
     plt.imshow(im[::-1])
     plt.show()
 
-plt.figure(figsize = (8,6))
-visualize_trajectory(train_dataset, index=90)
+if cfg["model_params"]["train"]:
+    plt.figure(figsize = (8,6))
+    visualize_trajectory(train_dataset, index=90)
 
 
 # define baseline model
+BACKBONES = {"resnet18": resnet18, "resnet34": resnet34, "resnet50": resnet50, "resnet101": resnet101}
+
+
 class LyftMultiModel(nn.Module):
 
     def __init__(self, cfg: Dict, num_modes=3):
         super().__init__()
 
         architecture = cfg["model_params"]["model_architecture"]
-        backbone = eval(architecture)(pretrained=True, progress=True)
+        # no pretrained weights, the whole model is loaded from weight_path afterwards
+        backbone = BACKBONES[architecture](weights=None)
         self.backbone = backbone
 
         num_history_channels = (cfg["model_params"]["history_num_frames"] + 1) * 2
@@ -214,14 +266,17 @@ class LyftMultiModel(nn.Module):
 
         # pred (batch_size)x(modes)x(time)x(2D coords)
         # confidences (batch_size)x(modes)
+        # both are views into the output of the last linear layer, no copies
         bs, _ = x.shape
-        pred, confidences = torch.split(x, self.num_preds, dim=1)
-        pred = pred.view(bs, self.num_modes, self.future_len, 2)
-        assert confidences.shape == (bs, self.num_modes)
-        confidences = torch.softmax(confidences, dim=1)
+        pred = x.narrow(1, 0, self.num_preds).view(bs, self.num_modes, self.future_len, 2)
+        confidences = x.narrow(1, self.num_preds, self.num_modes).softmax(dim=1)
         return pred, confidences
 
 
+# set LYFT_DEBUG=1 to validate the loss inputs on every call
+LYFT_DEBUG = __debug__ and bool(os.environ.get("LYFT_DEBUG"))
+
+
 # define multi-mode loss function
 def pytorch_neg_multi_log_likelihood_batch(
     gt: Tensor, pred: Tensor, confidences: Tensor, avails: Tensor
@@ -231,14 +286,22 @@ def pytorch_neg_multi_log_likelihood_batch(
 
     assert gt.shape == (batch_size, future_len, num_coords), f"expected 2D (Time x Coords) array for gt, got {gt.shape}"
     assert confidences.shape == (batch_size, num_modes), f"expected 1D (Modes) array for gt, got {confidences.shape}"
-    assert torch.allclose(torch.sum(confidences, dim=1), confidences.new_ones((batch_size,))), "confidences should sum to 1"
     assert avails.shape == (batch_size, future_len), f"expected 1D (Time) array for gt, got {avails.shape}"
-    # assert all data are valid
-    assert torch.isfinite(pred).all(), "invalid value found in pred"
-    assert torch.isfinite(gt).all(), "invalid value found in gt"
-    assert torch.isfinite(confidences).all(), "invalid value found in confidences"
-    assert torch.isfinite(avails).all(), "invalid value found in avails"
+    # the value checks launch a reduction and a sync each, so only run them when debugging
+    if LYFT_DEBUG:
+        assert torch.allclose(torch.sum(confidences, dim=1), confidences.new_ones((batch_size,))), "confidences should sum to 1"
+        # assert all data are valid
+        assert torch.isfinite(pred).all(), "invalid value found in pred"
+        assert torch.isfinite(gt).all(), "invalid value found in gt"
+        assert torch.isfinite(confidences).all(), "invalid value found in confidences"
+        assert torch.isfinite(avails).all(), "invalid value found in avails"
 
+    return _neg_multi_log_likelihood_core(gt, pred, confidences, avails)
+
+
+# scripted so the fuser can merge the pointwise chains between the reductions
+@torch.jit.script
+def _neg_multi_log_likelihood_core(gt: Tensor, pred: Tensor, confidences: Tensor, avails: Tensor) -> Tensor:
     # convert to (batch_size, num_modes, future_len, num_coords)
     gt = torch.unsqueeze(gt, 1)  # add modes
     avails = avails[:, None, :, None]  # add modes and cords
@@ -246,15 +309,13 @@ def pytorch_neg_multi_log_likelihood_batch(
     # error (batch_size, num_modes, future_len)
     error = torch.sum(((gt - pred) * avails) ** 2, dim=-1)  # reduce coords and use availability
 
-    with np.errstate(divide="ignore"):  # when confidence is 0 log goes to -inf, but we're fine with it
-        # error (batch_size, num_modes)
-        error = torch.log(confidences) - 0.5 * torch.sum(error, dim=-1)  # reduce time
-
-    # use max aggregator on modes for numerical stability
+    # when confidence is 0 log goes to -inf, but we're fine with it
     # error (batch_size, num_modes)
-    max_value, _ = error.max(dim=1, keepdim=True)  # error are negative at this point, so max() gives the minimum one
-    error = -torch.log(torch.sum(torch.exp(error - max_value), dim=-1, keepdim=True)) - max_value  # reduce modes
-    # print("error", error)
+    error = torch.log(confidences) - 0.5 * torch.sum(error, dim=-1)  # reduce time
+
+    # logsumexp subtracts the max internally, so it stays numerically stable
+    # error (batch_size)
+    error = -torch.logsumexp(error, dim=1)  # reduce modes
     return torch.mean(error)
 
 
@@ -279,34 +340,24 @@ def pytorch_neg_multi_log_likelihood_single(
 
 
 # wrap the forward function of LyftMultiModel
-def forward(data, model, device, criterion = pytorch_neg_multi_log_likelihood_batch):
-    inputs = data["image"].to(device)
-    target_availabilities = data["target_availabilities"].to(device)
-    targets = data["target_positions"].to(device)
-    # Forward pass
-    preds, confidences = model(inputs)
+# pass compute_loss=False for pure inference, targets are then not copied and the loss is None
+def forward(data, model, device, criterion = pytorch_neg_multi_log_likelihood_batch, compute_loss=True):
+    # batches come from pinned memory, so the copies can overlap with compute
+    inputs = data["image"].to(device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+    inputs = inputs.to(torch.float32).mul_(1 / 255.0)  # uint8 raster back to [0, 1]
+    # Forward pass, in mixed precision on GPU so the convolutions run on Tensor Cores
+    with torch.cuda.amp.autocast(enabled=device.type == "cuda"):
+        preds, confidences = model(inputs)
+    # keep the loss and the post-processing in FP32
+    preds, confidences = preds.float(), confidences.float()
+    if not compute_loss:
+        return None, preds, confidences
+    target_availabilities = data["target_availabilities"].to(device, non_blocking=True)
+    targets = data["target_positions"].to(device, non_blocking=True)
     loss = criterion(targets, preds, confidences, target_availabilities)
     return loss, preds, confidences
 
 
-import urllib
-import shutil
-
-# https://download.pytorch.org/models/resnet50-19c8e357.pth
-# shutil.copy("/kaggle/input/resnet50/resnet50-19c8e357.pth", 
-#             "/root/.cache/torch/hub/checkpoints/resnet50-19c8e357.pth")
-
-# https://download.pytorch.org/models/resnet34-333f7ec4.pth
-# shutil.copy("/kaggle/input/resnet34/resnet34-333f7ec4.pth", 
-#             "/root/.cache/torch/hub/checkpoints/resnet34-333f7ec4.pth")
-
-# https://download.pytorch.org/models/resnet18-5c106cde.pth
-# shutil.copy("/kaggle/input/resnet18/resnet18-5c106cde.pth", 
-#             "/root/.cache/torch/hub/checkpoints/resnet18-5c106cde.pth")
-
-os.listdir("/root/.cache/torch/hub/checkpoints/")
-
-
 # ==== INIT MODEL=================
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 model = LyftMultiModel(cfg)
@@ -317,6 +368,8 @@ if weight_path:
     model.load_state_dict(torch.load(weight_path))
 
 model.to(device)
+# NHWC lets cuDNN pick its Tensor Core kernels without transposing around every conv
+model = model.to(memory_format=torch.channels_last)
 optimizer = optim.Adam(model.parameters(), lr=cfg["model_params"]["lr"])
 print(f'device {device}')
 
@@ -325,48 +378,87 @@ print(f'device {device}')
 if cfg["model_params"]["predict"]:
     
     model.eval()
-    torch.set_grad_enabled(False)
-
-    # store information for evaluation
-    future_coords_offsets_pd = []
-    timestamps = []
-    confidences_list = []
-    agent_ids = []
-
-    progress_bar = tqdm(test_dataloader)
+    if device.type == "cpu":
+        # INT8 weights for the two large linear layers; dynamic quantization has no Conv2d support,
+        # so the backbone stays in FP32 on oneDNN with channels_last
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if device.type == "cuda" and hasattr(torch, "compile"):
+        # input shapes are fixed, so the forward is captured once and replayed as a CUDA graph;
+        # the final partial batch costs one extra compilation
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+    # store information for evaluation, preallocated so no final concatenation is needed
+    num_agents = len(test_dataset)
+    future_len = cfg["model_params"]["future_num_frames"]
+    future_coords_offsets_pd = np.empty((num_agents, model.num_modes, future_len, 2), dtype=np.float32)
+    timestamps = np.empty(num_agents, dtype=np.int64)
+    confidences_list = np.empty((num_agents, model.num_modes), dtype=np.float32)
+    agent_ids = np.empty(num_agents, dtype=np.int64)
+    offset = 0
+
+    # copy the predictions back on a side stream, so the next batch's forward can start meanwhile
+    copy_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+
+    def store_batch(start, copied, preds, confidences, batch_timestamps, batch_agent_ids):
+        if copied is not None:
+            copied.synchronize()
+        end = start + len(preds)
+        future_coords_offsets_pd[start:end] = preds.numpy()
+        confidences_list[start:end] = confidences.numpy()
+        timestamps[start:end] = batch_timestamps.numpy()
+        agent_ids[start:end] = batch_agent_ids.numpy()
+        return end
+
+    with torch.inference_mode():
+        progress_bar = tqdm(test_dataloader)
+        # the previous batch, whose host copy may still be in flight
+        pending = None
     
-    for data in progress_bar:
+        for data in progress_bar:
         
-        _, preds, confidences = forward(data, model, device)
+            _, preds, confidences = forward(data, model, device, compute_loss=False)
     
-        #fix for the new environment
-        preds = preds.cpu().numpy()
-        world_from_agents = data["world_from_agent"].numpy()
-        centroids = data["centroid"].numpy()
-        coords_offset = []
+            offset_from_agent = data["offset_from_agent"].to(device, non_blocking=True)
         
-        # convert into world coordinates and compute offsets
-        for idx in range(len(preds)):
-            for mode in range(3):
-                preds[idx, mode, :, :] = transform_points(preds[idx, mode, :, :], world_from_agents[idx]) - centroids[idx][:2]
+            # convert into world coordinates and compute offsets on the GPU, for the whole batch at once
+            # preds (batch_size)x(modes)x(time)x(2D coords), offset_from_agent (batch_size)x2x3
+            preds = torch.einsum("bij,bmtj->bmti", offset_from_agent[:, :, :2], preds) + offset_from_agent[:, None, None, :, 2]
+    
+            #fix for the new environment
+            copied = None
+            if copy_stream is not None:
+                # the compiled model reuses its output buffers on the next replay, so copy out of a clone
+                confidences = confidences.clone()
+                copy_stream.wait_stream(torch.cuda.current_stream(device))
+                with torch.cuda.stream(copy_stream):
+                    preds_cpu = preds.to("cpu", non_blocking=True)
+                    confidences_cpu = confidences.to("cpu", non_blocking=True)
+                    copied = torch.cuda.Event()
+                    copied.record()
+                # the device tensors must not be reused before the copy stream is done with them
+                preds.record_stream(copy_stream)
+                confidences.record_stream(copy_stream)
+            else:
+                preds_cpu, confidences_cpu = preds, confidences
+    
+            if pending is not None:
+                offset = store_batch(offset, *pending)
+            pending = (copied, preds_cpu, confidences_cpu, data["timestamp"], data["track_id"])
     
-        future_coords_offsets_pd.append(preds.copy())
-        confidences_list.append(confidences.cpu().numpy().copy())
-        timestamps.append(data["timestamp"].numpy().copy())
-        agent_ids.append(data["track_id"].numpy().copy())
+        if pending is not None:
+            offset = store_batch(offset, *pending)
 
 
 #create submission to submit to Kaggle
 pred_path = 'submission.csv'
 write_pred_csv(pred_path,
-           timestamps=np.concatenate(timestamps),
-           track_ids=np.concatenate(agent_ids),
-           coords=np.concatenate(future_coords_offsets_pd),
-           confs = np.concatenate(confidences_list)
+           timestamps=timestamps,
+           track_ids=agent_ids,
+           coords=future_coords_offsets_pd,
+           confs = confidences_list
           )
 
 
 print (os.listdir("."))
 print (os.path.abspath("."))
-coords = np.concatenate(future_coords_offsets_pd)
-print (coords.shape)
\ No newline at end of file
+print (future_coords_offsets_pd.shape)
\ No newline at end of file